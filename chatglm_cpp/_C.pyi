@@ -2,8 +2,9 @@
 ChatGLM.cpp python binding
 """
 from __future__ import annotations
+import numpy
 import typing
-__all__ = ['BaseModelForCausalLM', 'BaseTokenizer', 'ChatGLM2ForCausalLM', 'ChatGLM2Tokenizer', 'ChatGLM3Tokenizer', 'ChatGLM4Tokenizer', 'ChatGLMForCausalLM', 'ChatGLMTokenizer', 'ChatMessage', 'CodeMessage', 'FunctionMessage', 'GenerationConfig', 'ModelConfig', 'ModelType', 'Pipeline', 'ToolCallMessage']
+__all__ = ['BaseModelForCausalLM', 'BaseTokenizer', 'ChatGLM2ForCausalLM', 'ChatGLM2Tokenizer', 'ChatGLM3Tokenizer', 'ChatGLM4Tokenizer', 'ChatGLMForCausalLM', 'ChatGLMTokenizer', 'ChatMessage', 'CodeMessage', 'FunctionMessage', 'GenerationConfig', 'ModelConfig', 'ModelType', 'Pipeline', 'ToolCallMessage', 'quantize_q4_0', 'quantize_q8_0']
 class BaseModelForCausalLM:
     def generate_next_token(self, input_ids: list[int], gen_config: GenerationConfig, n_past: int, n_ctx: int) -> int:
         ...
@@ -175,3 +176,7 @@ class ToolCallMessage:
         ...
     def __str__(self) -> str:
         ...
+def quantize_q4_0(x: numpy.ndarray[numpy.float32]) -> numpy.ndarray[numpy.int8]:
+    ...
+def quantize_q8_0(x: numpy.ndarray[numpy.float32]) -> numpy.ndarray[numpy.int8]:
+    ...
@@ -3,24 +3,39 @@ Convert Hugging Face ChatGLM family models to GGML format
 """
 
 import argparse
+import json
+import os
 import platform
 import struct
 import sys
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import Executor
+from contextlib import ExitStack
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import BinaryIO, Optional
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
+from huggingface_hub import snapshot_download
+from safetensors import safe_open
 from tabulate import tabulate
 from tqdm import tqdm
 from transformers import AutoConfig, AutoModel, AutoModelForCausalLM, AutoTokenizer
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
 
 try:
     import tiktoken
 except ImportError:
     tiktoken = None
 
+try:
+    from chatglm_cpp import _C
+except ImportError:
+    _C = None
+
 GGML_QK8_0 = 32
 GGML_QK4_0 = 32
 GGML_QK4_1 = 32
@@ -28,6 +43,16 @@ GGML_QK5_0 = 32
 GGML_QK5_1 = 32
 
 GGML_MEM_ALIGN = 16
+GGML_MAX_DIMS = 4
+
+DUMP_CHUNK_SIZE = 16 * 1024 * 1024  # max bytes of float32 weights to encode at a time
+DUMP_MAX_PENDING_CHUNKS = 2 * (os.cpu_count() or 1)  # max chunks encoded ahead of writing with an executor
+
+# pre-compiled binary layouts of the serialized headers
+INT_STRUCT = struct.Struct("i")
+CONFIG_STRUCT = struct.Struct("iiiiiiiififiii")  # config version & config values
+# tensor ndim, shape & dtype
+TENSOR_HEADER_STRUCTS = {ndim: struct.Struct("i" * (2 + ndim)) for ndim in range(1, GGML_MAX_DIMS + 1)}
 
 if platform.system() == "Darwin":
     # cpm_kernels doesn't support macOS but transformers will check missing packages, so mock it
@@ -54,91 +79,106 @@ class ModelType(Enum):
 def quantize_q8_0(tensor: torch.Tensor) -> torch.Tensor:
     # equivalent to ggml_quantize_q8_0 in ggml.c
     assert tensor.shape[1] % GGML_QK8_0 == 0
-    tensor = tensor.view(-1, GGML_QK8_0)
-    scale = tensor.abs().max(dim=-1, keepdim=True).values / ((1 << 7) - 1)
-    tensor = (tensor / scale).round().clamp(min=-128, max=127).char()
-    # add scale into each block
-    tensor = torch.cat((scale.half().view(torch.int8), tensor), dim=-1)
-    return tensor
+    tensor = tensor.float().contiguous().view(-1, GGML_QK8_0)
+    scale = tensor.abs().amax(dim=-1, keepdim=True) / ((1 << 7) - 1)
+    # write scale & quantized weights into each block of a pre-allocated output
+    out = torch.empty((tensor.shape[0], 2 + GGML_QK8_0), dtype=torch.int8, device=tensor.device)
+    out[:, :2].view(torch.half).copy_(scale)
+    out[:, 2:] = (tensor / scale).round_().clamp_(min=-128, max=127)
+    return out
 
 
 def quantize_q4_0(tensor: torch.Tensor) -> torch.Tensor:
     # equivalent to ggml_quantize_q4_0 in ggml.c
     assert tensor.shape[1] % GGML_QK4_0 == 0
-    tensor = tensor.view(-1, GGML_QK4_0)
+    tensor = tensor.float().contiguous().view(-1, GGML_QK4_0)
     abs_max_indices = tensor.abs().max(dim=-1, keepdim=True).indices
     max_values = torch.take_along_dim(tensor, abs_max_indices, dim=-1)
     scale = max_values / -8
-    tensor = (tensor / scale + 8).round().clamp(min=0, max=15).char()
-    # compress two int4 weights into an int8
-    tensor = tensor[:, :16] | (tensor[:, 16:] << 4)
-    # add scale into each block
-    tensor = torch.cat((scale.half().view(torch.int8), tensor), dim=-1)
-    return tensor
+    tensor = (tensor / scale).add_(8).round_().clamp_(min=0, max=15).char()
+    # write scale into the header of each block
+    out = torch.empty((tensor.shape[0], 2 + GGML_QK4_0 // 2), dtype=torch.int8, device=tensor.device)
+    out[:, :2].view(torch.half).copy_(scale)
+    # compress two int4 weights into an int8: byte i holds w[i] in its low nibble and w[i + 16] in its high nibble,
+    # which is the layout ggml unpacks with a single mask and a single shift over a whole SIMD register
+    torch.bitwise_or(tensor[:, :16], tensor[:, 16:] << 4, out=out[:, 2:])
+    return out
 
 
 def quantize_q4_1(tensor: torch.Tensor) -> torch.Tensor:
     # equivalent to ggml_quantize_q4_1 in ggml.c
     assert tensor.shape[1] % GGML_QK4_1 == 0
-    tensor = tensor.view(-1, GGML_QK4_1)
-    min_vals = tensor.min(dim=-1, keepdim=True).values
-    max_vals = tensor.max(dim=-1, keepdim=True).values
+    tensor = tensor.float().contiguous().view(-1, GGML_QK4_1)
+    min_vals, max_vals = tensor.aminmax(dim=-1, keepdim=True)
     scale = (max_vals - min_vals) / ((1 << 4) - 1)
-    tensor = ((tensor - min_vals) / scale).round().clamp(min=0, max=15).char()
+    tensor = (tensor - min_vals).div_(scale).round_().clamp_(min=0, max=15).char()
+    # write scale & min into the header of each block
+    out = torch.empty((tensor.shape[0], 4 + GGML_QK4_1 // 2), dtype=torch.int8, device=tensor.device)
+    out[:, :2].view(torch.half).copy_(scale)
+    out[:, 2:4].view(torch.half).copy_(min_vals)
     # compress two int4 weights into an int8
-    tensor = tensor[:, :16] | (tensor[:, 16:] << 4)
-    # add scale & min into each block
-    tensor = torch.cat((scale.half().view(torch.int8), min_vals.half().view(torch.int8), tensor), dim=-1)
-    return tensor
+    torch.bitwise_or(tensor[:, :16], tensor[:, 16:] << 4, out=out[:, 4:])
+    return out
 
 
 def quantize_q5_0(tensor: torch.Tensor) -> torch.Tensor:
     # equivalent to ggml_quantize_q5_0 in ggml.c
     assert tensor.shape[1] % GGML_QK5_0 == 0
-    tensor = tensor.view(-1, GGML_QK5_0)
+    tensor = tensor.float().contiguous().view(-1, GGML_QK5_0)
     abs_max_indices = tensor.abs().max(dim=-1, keepdim=True).indices
     max_values = torch.take_along_dim(tensor, abs_max_indices, dim=-1)
     scale = max_values / -16
-    tensor = (tensor / scale + 16).round().clamp(min=0, max=31).char()
-    qs = (tensor[:, :16] & 0x0F) | (tensor[:, 16:] << 4)
-    qh = torch.zeros(tensor.shape[:-1], dtype=torch.int32)
-    for i in range(32):
-        qh |= ((tensor[:, i] & 0x10) >> 4).int() << i
-
-    # add scale into each block
-    tensor = torch.cat((scale.half().view(torch.int8), qh[..., None].view(torch.int8), qs), dim=-1)
-    return tensor
+    tensor = (tensor / scale).add_(16).round_().clamp_(min=0, max=31).char()
+    # gather the 5th bit of all 32 weights into an int32 at once: weight i contributes only bit i, so summing the
+    # shifted bits never carries and equals OR-ing them (bit 31 lands on the int32 sign bit, which is fine)
+    shifts = torch.arange(32, dtype=torch.int32, device=tensor.device)
+    qh = (((tensor & 0x10) >> 4).int() << shifts).sum(dim=-1, dtype=torch.int32)
+
+    # write scale & high bits into the header of each block
+    out = torch.empty((tensor.shape[0], 6 + GGML_QK5_0 // 2), dtype=torch.int8, device=tensor.device)
+    out[:, :2].view(torch.half).copy_(scale)
+    out[:, 2:6] = qh[..., None].view(torch.int8)
+    # compress the low 4 bits of two weights into an int8
+    torch.bitwise_or(tensor[:, :16] & 0x0F, tensor[:, 16:] << 4, out=out[:, 6:])
+    return out
 
 
 def quantize_q5_1(tensor: torch.Tensor) -> torch.Tensor:
     # equivalent to ggml_quantize_q5_1 in ggml.c
     assert tensor.shape[1] % GGML_QK5_1 == 0
-    tensor = tensor.view(-1, GGML_QK5_1)
-    min_vals = tensor.min(dim=-1, keepdim=True).values
-    max_vals = tensor.max(dim=-1, keepdim=True).values
+    tensor = tensor.float().contiguous().view(-1, GGML_QK5_1)
+    min_vals, max_vals = tensor.aminmax(dim=-1, keepdim=True)
     scale = (max_vals - min_vals) / ((1 << 5) - 1)
-    tensor = ((tensor - min_vals) / scale).round().clamp(min=0, max=31).char()
-    qs = (tensor[:, :16] & 0x0F) | (tensor[:, 16:] << 4)
-    qh = torch.zeros(tensor.shape[:-1], dtype=torch.int32)
-    for i in range(32):
-        qh |= ((tensor[:, i] & 0x10) >> 4).int() << i
-
-    # add scale & min into each block
-    tensor = torch.cat(
-        (scale.half().view(torch.int8), min_vals.half().view(torch.int8), qh[..., None].view(torch.int8), qs), dim=-1
-    )
-    return tensor
-
+    tensor = (tensor - min_vals).div_(scale).round_().clamp_(min=0, max=31).char()
+    # gather the 5th bit of all 32 weights into an int32 at once: weight i contributes only bit i, so summing the
+    # shifted bits never carries and equals OR-ing them (bit 31 lands on the int32 sign bit, which is fine)
+    shifts = torch.arange(32, dtype=torch.int32, device=tensor.device)
+    qh = (((tensor & 0x10) >> 4).int() << shifts).sum(dim=-1, dtype=torch.int32)
+
+    # write scale, min & high bits into the header of each block
+    out = torch.empty((tensor.shape[0], 8 + GGML_QK5_1 // 2), dtype=torch.int8, device=tensor.device)
+    out[:, :2].view(torch.half).copy_(scale)
+    out[:, 2:4].view(torch.half).copy_(min_vals)
+    out[:, 4:8] = qh[..., None].view(torch.int8)
+    # compress the low 4 bits of two weights into an int8
+    torch.bitwise_or(tensor[:, :16] & 0x0F, tensor[:, 16:] << 4, out=out[:, 8:])
+    return out
+
+
+def encode_tensor(tensor: torch.Tensor, ggml_type: GGMLType, native_quantize: bool = False) -> torch.Tensor:
+    # With native_quantize, q8_0/q4_0 weights on cpu are quantized by ggml itself through the _C extension, falling
+    # back to torch if _C is not built or was built before the native quantizers were added. Since ggml multiplies by
+    # the reciprocal scale and rounds halfway values its own way, a few weights may end up one level apart from the
+    # torch quantizers, so this is opt-in.
+    if native_quantize and tensor.device.type == "cpu":
+        native_quantize_fns = {
+            GGMLType.Q8_0: getattr(_C, "quantize_q8_0", None),
+            GGMLType.Q4_0: getattr(_C, "quantize_q4_0", None),
+        }
+        quantize_fn = native_quantize_fns.get(ggml_type)
+        if quantize_fn is not None:
+            return torch.from_numpy(quantize_fn(tensor.float().numpy()))
 
-def dump_tensor(f, name: str, tensor: torch.Tensor, ggml_type: GGMLType):
-    # tensor name
-    f.write(struct.pack("i", len(name.encode())))
-    f.write(name.encode())
-
-    # tensor shape & dtype
-    f.write(struct.pack("i" * (2 + tensor.ndim), tensor.ndim, *tensor.shape, ggml_type.value))
-
-    # tensor data
     if ggml_type == GGMLType.F32:
         tensor = tensor.float()
     elif ggml_type == GGMLType.F16:
@@ -155,58 +195,158 @@ def dump_tensor(f, name: str, tensor: torch.Tensor, ggml_type: GGMLType):
         tensor = quantize_q5_1(tensor)
     else:
         raise NotImplementedError(f"Cannot dump tensor of dtype {tensor.dtype}")
-
-    # align address
-    aligned_pos = (f.tell() + (GGML_MEM_ALIGN - 1)) // GGML_MEM_ALIGN * GGML_MEM_ALIGN
-    f.seek(aligned_pos)
-    tensor.numpy().tofile(f)
+    return tensor
 
 
-def dump_state_dict(f, weight_names, state_dict, quantization_bit, ggml_type):
+def ordered_map(executor: Executor, fn: Callable, items: Iterable, max_pending: int) -> Iterator:
+    # like executor.map, but submits lazily and keeps at most max_pending results in flight
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def dequantize_weight(tensor: torch.Tensor, scale: torch.Tensor, quantization_bit: int) -> torch.Tensor:
+    # de-quantize an int8/int4 weight with channel-wise scale back to float32
+    assert quantization_bit in [4, 8]
+    if quantization_bit == 4:
+        # convert int4 weight to int8: each byte holds the high & low nibbles of two adjacent weights
+        int4_tensor = tensor.view(torch.uint8)  # logical shifts, no sign extension
+        tensor = torch.empty(
+            (int4_tensor.shape[0], int4_tensor.shape[1] * 2), dtype=torch.int8, device=int4_tensor.device
+        )
+        tensor[:, 0::2] = int4_tensor >> 4
+        tensor[:, 1::2] = int4_tensor & 0x0F
+        tensor.bitwise_xor_(0x08).sub_(0x08)  # sign-extend int4 to int8 in-place
+    return tensor * scale[:, None]
+
+
+def encode_chunk(
+    tensor: torch.Tensor,
+    rows: slice,
+    ggml_type: GGMLType,
+    scale: Optional[torch.Tensor] = None,
+    quantization_bit: Optional[int] = None,
+    device: str = "cpu",
+    native_quantize: bool = False,
+) -> torch.Tensor:
+    chunk = tensor[rows].to(device, non_blocking=True)
+    if scale is not None:
+        chunk = dequantize_weight(chunk, scale[rows].to(device, non_blocking=True), quantization_bit)
+    return encode_tensor(chunk, ggml_type, native_quantize).cpu()
+
+
+def write_tensor_header(f, name: str, shape: Tuple[int, ...], ggml_type: GGMLType):
+    # tensor name, shape & dtype
+    name_bytes = name.encode()
+    shape_header = TENSOR_HEADER_STRUCTS[len(shape)].pack(len(shape), *shape, ggml_type.value)
+    header = INT_STRUCT.pack(len(name_bytes)) + name_bytes + shape_header
+
+    # align address with explicit zero padding, so the whole header goes out in one write without a seek
+    padding = -(f.tell() + len(header)) % GGML_MEM_ALIGN
+    f.write(header + b"\0" * padding)
+
+
+def dump_tensors(
+    f,
+    tensors: Iterable[Tuple[str, torch.Tensor, GGMLType, Optional[torch.Tensor]]],
+    executor: Optional[Executor] = None,
+    quantization_bit: Optional[int] = None,
+    device: str = "cpu",
+    native_quantize: bool = False,
+) -> List[Tuple[str, Tuple[int, ...], GGMLType]]:
+    # tensors are (name, tensor, ggml_type, scale) tuples, where a non-null scale indicates an int8/int4 weight
+    # that is de-quantized on the fly, one chunk at a time
     tensor_info = []
-    for name in tqdm(weight_names, desc="Processing model states"):
-        tensor = state_dict[name]
-        if name == "past_key_values":
-            tensor_ggml_type = GGMLType.F16
-        elif tensor.ndim == 2:
-            # 2d weight: should quantize it if needed
-
-            # step 1: de-quantize it back to float32
-            if tensor.dtype == torch.int8:
-                assert quantization_bit in [4, 8]
-                scale = state_dict[f"{name}_scale"].float()  # channel-wise scale
-
-                if quantization_bit == 4:
-                    # convert int4 weight to int8
-                    low_bits = ((tensor << 4) & 0xF0) >> 4
-                    high_bits = (tensor & 0xF0) >> 4
-                    tensor = torch.stack((high_bits, low_bits), dim=-1).view(tensor.shape[0], -1)
-                tensor = tensor * scale[:, None]
+
+    def iter_chunk_jobs():
+        for name, tensor, ggml_type, scale in tensors:
+            shape = tuple(tensor.shape)
+            if scale is not None and quantization_bit == 4:
+                shape = (shape[0], shape[1] * 2)
+            tensor_info.append((name, shape, ggml_type))
+
+            # tensor data: de-quantize, encode & write a few rows at a time so that peak memory stays bounded
+            row_size = torch.Size(shape[1:]).numel() * 4  # float32 bytes
+            chunk_rows = max(DUMP_CHUNK_SIZE // row_size, 1)
+            if shape[0] == 0:
+                # no rows to encode, but the header is still written
+                yield (name, shape, ggml_type), None
+            for start in range(0, shape[0], chunk_rows):
+                # the tensor header goes right before its first chunk
+                header = (name, shape, ggml_type) if start == 0 else None
+                rows = slice(start, start + chunk_rows)
+                yield header, partial(
+                    encode_chunk, tensor, rows, ggml_type, scale, quantization_bit, device, native_quantize
+                )
+
+    def run_chunk_job(job):
+        header, encode_fn = job
+        return header, encode_fn() if encode_fn is not None else None
+
+    if executor is not None:
+        # encode chunks on worker threads (torch ops release the GIL) while writing them in order. chunks of all
+        # tensors flow through the same pipeline, so the workers keep busy across tensor boundaries.
+        results = ordered_map(executor, run_chunk_job, iter_chunk_jobs(), max_pending=DUMP_MAX_PENDING_CHUNKS)
+    else:
+        results = map(run_chunk_job, iter_chunk_jobs())
+    for header, chunk in results:
+        if header is not None:
+            write_tensor_header(f, *header)
+        if chunk is None:
+            continue
+        # zero-copy write through the file buffer, avoiding the flush & re-seek of numpy tofile on every chunk
+        f.write(chunk.contiguous().numpy().data)
+
+    return tensor_info
+
+
+def dump_state_dict(f, weight_names, state_dict, quantization_bit, ggml_type, device="cpu", native_quantize=False):
+    def iter_tensors():
+        for name in tqdm(weight_names, desc="Processing model states"):
+            tensor = state_dict[name]
+            scale = None
+            if name == "past_key_values":
+                tensor_ggml_type = GGMLType.F16
+            elif tensor.ndim == 2:
+                # 2d weight: should quantize it if needed
+
+                # step 1: int8/int4 weight is de-quantized back to float32 chunk by chunk in dump_tensors,
+                # while float weight is up-casted to float32 chunk by chunk in quantization
+                if tensor.dtype == torch.int8:
+                    scale = state_dict[f"{name}_scale"].float()  # channel-wise scale
+
+                # step 2: quantize it into ggml format
+                tensor_ggml_type = ggml_type
             else:
+                # 1d weight: convert it to float32
+                assert tensor.ndim == 1
                 tensor = tensor.float()
+                tensor_ggml_type = GGMLType.F32
 
-            # step 2: quantize it into ggml format
-            tensor_ggml_type = ggml_type
-        else:
-            # 1d weight: convert it to float32
-            assert tensor.ndim == 1
-            tensor = tensor.float()
-            tensor_ggml_type = GGMLType.F32
+            yield name, tensor, tensor_ggml_type, scale
 
-        dump_tensor(f, name, tensor, tensor_ggml_type)
-        tensor_info.append((name, tuple(tensor.shape), tensor_ggml_type.name))
+    tensor_info = dump_tensors(
+        f, iter_tensors(), quantization_bit=quantization_bit, device=device, native_quantize=native_quantize
+    )
 
+    tensor_info = [(name, shape, tensor_ggml_type.name) for name, shape, tensor_ggml_type in tensor_info]
     print(tabulate(tensor_info, headers=["name", "shape", "dtype"], tablefmt="psql"))
 
 
 class BaseConverter:
     @classmethod
-    def convert(cls, f, model, tokenizer, ggml_type):
+    def convert(
+        cls, f, config, state_dict, tokenizer, ggml_type, device="cpu", prefix_encoder=None, native_quantize=False
+    ):
         f.write(b"ggml")  # magic
-        f.write(struct.pack("i", cls.MODEL_TYPE.value))  # model type
-        cls.dump_config(f, model.config, ggml_type)
+        f.write(INT_STRUCT.pack(cls.MODEL_TYPE.value))  # model type
+        cls.dump_config(f, config, ggml_type)
         cls.dump_tokenizer(f, tokenizer)
-        cls.dump_model(f, model, ggml_type)
+        cls.dump_model(f, config, state_dict, ggml_type, device, prefix_encoder, native_quantize)
 
 
 def get_prefix_cache(prefix_encoder, pre_seq_len, num_layers, num_key_value_heads, head_size):
@@ -248,22 +388,22 @@ class ChatGLMConverter(BaseConverter):
             config.eos_token_id if config.eos_token_id is not None else -1,
             config.pad_token_id if config.pad_token_id is not None else -1,
         ]
-        f.write(struct.pack("iiiiiiiififiii", config_version, *config_values))
+        f.write(CONFIG_STRUCT.pack(config_version, *config_values))
 
     @staticmethod
     def dump_tokenizer(f, tokenizer):
         serialized_model_proto = tokenizer.sp_tokenizer.text_tokenizer.sp.serialized_model_proto()
-        f.write(struct.pack("i", len(serialized_model_proto)))
+        f.write(INT_STRUCT.pack(len(serialized_model_proto)))
         f.write(serialized_model_proto)
 
     @staticmethod
-    def dump_model(f, model, ggml_type):
+    def dump_model(f, config, state_dict, ggml_type, device="cpu", prefix_encoder=None, native_quantize=False):
         assert torch.allclose(
-            model.state_dict()["transformer.word_embeddings.weight"], model.state_dict()["lm_head.weight"]
+            state_dict["transformer.word_embeddings.weight"], state_dict["lm_head.weight"]
         ), "unimplemented: lm_head weight must be tied to input embedding"
 
         weight_names = ["transformer.word_embeddings.weight"]
-        for i in range(model.config.num_layers):
+        for i in range(config.num_layers):
             weight_names += [
                 f"transformer.layers.{i}.input_layernorm.weight",
                 f"transformer.layers.{i}.input_layernorm.bias",
@@ -282,7 +422,7 @@ class ChatGLMConverter(BaseConverter):
             "transformer.final_layernorm.weight",
             "transformer.final_layernorm.bias",
         ]
-        dump_state_dict(f, weight_names, model.state_dict(), model.config.quantization_bit, ggml_type)
+        dump_state_dict(f, weight_names, state_dict, config.quantization_bit, ggml_type, device, native_quantize)
 
 
 class ChatGLM2Converter(BaseConverter):
@@ -320,24 +460,20 @@ class ChatGLM2Converter(BaseConverter):
             config.pad_token_id if config.pad_token_id is not None else -1,
         ]
 
-        f.write(struct.pack("iiiiiiiififiii", config_version, *config_values))
+        f.write(CONFIG_STRUCT.pack(config_version, *config_values))
 
     @staticmethod
     def dump_tokenizer(f, tokenizer):
         serialized_model_proto = tokenizer.tokenizer.sp_model.serialized_model_proto()
-        f.write(struct.pack("i", len(serialized_model_proto)))
+        f.write(INT_STRUCT.pack(len(serialized_model_proto)))
         f.write(serialized_model_proto)
 
     @staticmethod
-    def dump_model(f, model, ggml_type):
-        config = model.config
-
-        state_dict = model.state_dict()
-
+    def dump_model(f, config, state_dict, ggml_type, device="cpu", prefix_encoder=None, native_quantize=False):
         weight_names = []
         if getattr(config, "pre_seq_len", None) is not None and config.pre_seq_len > 0:
             past_key_values = get_prefix_cache(
-                model.transformer.prefix_encoder,
+                prefix_encoder,
                 config.pre_seq_len,
                 config.num_layers,
                 config.multi_query_group_num,
@@ -367,6 +503,8 @@ class ChatGLM2Converter(BaseConverter):
             state_dict=state_dict,
             quantization_bit=getattr(config, "quantization_bit", None),
             ggml_type=ggml_type,
+            device=device,
+            native_quantize=native_quantize,
         )
 
 
@@ -380,11 +518,64 @@ class ChatGLM4Converter(ChatGLM2Converter):
     @staticmethod
     def dump_tokenizer(f, tokenizer):
         vocab_text = Path(tokenizer.vocab_file).read_bytes()
-        f.write(struct.pack("i", len(vocab_text)))
+        f.write(INT_STRUCT.pack(len(vocab_text)))
         f.write(vocab_text)
 
 
-def convert(f: BinaryIO, model_name_or_path: str, lora_model_name_or_path: Optional[str] = None, dtype: str = "q4_0"):
+class SafetensorsStateDict(Mapping):
+    # read-only state dict that loads each tensor from safetensors checkpoint files only when it is looked up.
+    # the checkpoint files stay open until close() is called, or the with block exits.
+    def __init__(self, paths: List[Path]):
+        self.exit_stack = ExitStack()
+        self.files = [self.exit_stack.enter_context(safe_open(str(path), framework="pt")) for path in paths]
+        self.name_to_file = {name: file for file in self.files for name in file.keys()}
+
+    def close(self) -> None:
+        self.exit_stack.close()
+
+    def __enter__(self) -> "SafetensorsStateDict":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __getitem__(self, name: str) -> torch.Tensor:
+        return self.name_to_file[name].get_tensor(name)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.name_to_file)
+
+    def __len__(self) -> int:
+        return len(self.name_to_file)
+
+
+def load_safetensors_state_dict(model_name_or_path: str) -> Optional[SafetensorsStateDict]:
+    model_dir = Path(model_name_or_path)
+    if not model_dir.is_dir():
+        model_dir = Path(
+            snapshot_download(model_name_or_path, allow_patterns=[SAFE_WEIGHTS_INDEX_NAME, "*.safetensors"])
+        )
+
+    if (model_dir / SAFE_WEIGHTS_INDEX_NAME).is_file():
+        # sharded checkpoint
+        weight_map = json.loads((model_dir / SAFE_WEIGHTS_INDEX_NAME).read_text())["weight_map"]
+        paths = [model_dir / file_name for file_name in sorted(set(weight_map.values()))]
+    elif (model_dir / SAFE_WEIGHTS_NAME).is_file():
+        paths = [model_dir / SAFE_WEIGHTS_NAME]
+    else:
+        return None
+
+    return SafetensorsStateDict(paths)
+
+
+def convert(
+    f: BinaryIO,
+    model_name_or_path: str,
+    lora_model_name_or_path: Optional[str] = None,
+    dtype: str = "q4_0",
+    device: str = "cpu",
+    native_quantize: bool = False,
+):
     ggml_type = GGMLType[dtype.upper()]
 
     tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, trust_remote_code=True)
@@ -397,33 +588,59 @@ def convert(f: BinaryIO, model_name_or_path: str, lora_model_name_or_path: Optio
     else:
         raise RuntimeError(f"Cannot find auto model class to load {model_name_or_path}")
 
-    model = auto_model_class.from_pretrained(model_name_or_path, trust_remote_code=True, low_cpu_mem_usage=True)
+    # Stream weights from safetensors checkpoint one at a time if possible, so that peak memory is bounded by the
+    # largest tensor instead of the whole model. Fall back to loading the entire model when weights have to be
+    # computed by the model (lora merging or p-tuning prefix), or when the checkpoint is quantized or not in the
+    # safetensors format.
+    state_dict = None
+    prefix_encoder = None
+    if (
+        config.model_type == "chatglm"
+        and hasattr(config, "multi_query_attention")
+        and lora_model_name_or_path is None
+        and not getattr(config, "pre_seq_len", None)
+        and not getattr(config, "quantization_bit", None)
+    ):
+        state_dict = load_safetensors_state_dict(model_name_or_path)
+
+    if state_dict is None:
+        model = auto_model_class.from_pretrained(model_name_or_path, trust_remote_code=True, low_cpu_mem_usage=True)
 
-    if lora_model_name_or_path is not None:
-        from peft import PeftModel
+        if lora_model_name_or_path is not None:
+            from peft import PeftModel
 
-        model = PeftModel.from_pretrained(model, lora_model_name_or_path)
-        model = model.merge_and_unload()
+            model = PeftModel.from_pretrained(model, lora_model_name_or_path)
+            model = model.merge_and_unload()
 
-    model = model.eval()
+        model = model.eval()
 
-    if model.config.model_type == "chatglm":
-        if hasattr(model.config, "multi_query_attention"):
+        config = model.config
+        state_dict = model.state_dict()
+        prefix_encoder = getattr(model.transformer, "prefix_encoder", None)
+
+    if config.model_type == "chatglm":
+        if hasattr(config, "multi_query_attention"):
             # ChatGLM 2,3,4 share the same architecture and model config but their tokenizers are different.
             # ChatGLM4 uses tiktoken tokenizer, while ChatGLM 2,3 uses sentencepiece.
             # ChatGLM3 has system token to support system prompt, while ChatGLM2 does not.
             if tiktoken is not None and isinstance(tokenizer.tokenizer, tiktoken.Encoding):
                 # TODO: store all eos token ids
-                model.config.eos_token_id = tokenizer.eos_token_id
-                ChatGLM4Converter.convert(f, model, tokenizer, ggml_type)
+                config.eos_token_id = tokenizer.eos_token_id
+                converter_class = ChatGLM4Converter
             elif "<|system|>" in tokenizer.tokenizer.special_tokens:
-                ChatGLM3Converter.convert(f, model, tokenizer, ggml_type)
+                converter_class = ChatGLM3Converter
             else:
-                ChatGLM2Converter.convert(f, model, tokenizer, ggml_type)
+                converter_class = ChatGLM2Converter
         else:
-            ChatGLMConverter.convert(f, model, tokenizer, ggml_type)
+            converter_class = ChatGLMConverter
     else:
-        raise RuntimeError(f"Unknown model type {model.config.model_type}")
+        raise RuntimeError(f"Unknown model type {config.model_type}")
+
+    try:
+        converter_class.convert(f, config, state_dict, tokenizer, ggml_type, device, prefix_encoder, native_quantize)
+    finally:
+        if isinstance(state_dict, SafetensorsStateDict):
+            state_dict.close()
 
 
 def main():
@@ -453,10 +670,28 @@ def main():
         choices=["f32", "f16", "q8_0", "q4_0", "q4_1", "q5_0", "q5_1"],
         help="GGML model quantization type",
     )
+    parser.add_argument(
+        "--device",
+        default="cpu",
+        type=str,
+        help="Device to quantize weights on, e.g. cuda to speed up conversion on GPU",
+    )
+    parser.add_argument(
+        "--native_quantize",
+        action="store_true",
+        help="Quantize q8_0/q4_0 weights on cpu with ggml through the chatglm_cpp extension if it is installed",
+    )
     args = parser.parse_args()
 
     with open(args.save_path, "wb") as f:
-        convert(f, args.model_name_or_path, args.lora_model_name_or_path, dtype=args.type)
+        convert(
+            f,
+            args.model_name_or_path,
+            args.lora_model_name_or_path,
+            dtype=args.type,
+            device=args.device,
+            native_quantize=args.native_quantize,
+        )
 
     print(f"GGML model saved to {args.save_path}")
 
@@ -1,4 +1,5 @@
 #include "chatglm.h"
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 
@@ -48,6 +49,28 @@ static inline std::string to_string(const T &obj) {
     return oss.str();
 }
 
+// quantize a 2d float32 array with ggml, returning one row of bytes per block
+template <ggml_type TYPE>
+static py::array_t<int8_t> quantize(py::array_t<float, py::array::c_style | py::array::forcecast> x) {
+    CHATGLM_CHECK(x.ndim() == 2) << "expect 2d array, got " << x.ndim() << "d";
+    const int64_t num_rows = x.shape(0);
+    const int64_t num_cols = x.shape(1);
+    CHATGLM_CHECK(num_cols % ggml_blck_size(TYPE) == 0)
+        << "row size " << num_cols << " is not a multiple of block size " << ggml_blck_size(TYPE);
+
+    const int64_t num_blocks = num_rows * num_cols / ggml_blck_size(TYPE);
+    py::array_t<int8_t> out({(py::ssize_t)num_blocks, (py::ssize_t)ggml_type_size(TYPE)});
+    const float *src = x.data();
+    int8_t *dst = out.mutable_data();
+    size_t num_bytes;
+    {
+        py::gil_scoped_release release;
+        num_bytes = ggml_quantize_chunk(TYPE, src, dst, 0, num_rows, num_cols, nullptr);
+    }
+    CHATGLM_CHECK(num_bytes == (size_t)out.nbytes()) << "expect " << out.nbytes() << " bytes, got " << num_bytes;
+    return out;
+}
+
 PYBIND11_MODULE(_C, m) {
     m.doc() = "ChatGLM.cpp python binding";
 
@@ -156,6 +179,11 @@ PYBIND11_MODULE(_C, m) {
         .def(py::init<const std::string &, int>(), "path"_a, "max_length"_a = -1)
         .def_property_readonly("model", [](const Pipeline &self) { return self.model.get(); })
         .def_property_readonly("tokenizer", [](const Pipeline &self) { return self.tokenizer.get(); });
+
+    // ===== Quantization ====
+
+    m.def("quantize_q4_0", &quantize<GGML_TYPE_Q4_0>, "x"_a);
+    m.def("quantize_q8_0", &quantize<GGML_TYPE_Q8_0>, "x"_a);
 }
 
 } // namespace chatglm
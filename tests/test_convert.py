@@ -1,16 +1,30 @@
+import json
+import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from types import SimpleNamespace
 
+import pytest
 import torch
 import torch.nn.functional as F
 from chatglm_cpp.convert import (
+    _C,
+    GGMLType,
+    convert,
+    dequantize_weight,
+    dump_state_dict,
+    dump_tensors,
+    encode_tensor,
     get_prefix_cache,
+    load_safetensors_state_dict,
     quantize_q4_0,
     quantize_q4_1,
     quantize_q5_0,
     quantize_q5_1,
     quantize_q8_0,
 )
+from safetensors.torch import save_file
 
 HERE = Path(__file__).resolve().parent
 
@@ -106,6 +120,15 @@ def test_quantize_q4_0():
     assert (q_tensor == ggml_q_tensor).all()
 
 
+def test_quantize_q4_0_layout():
+    # absmax is -8 at index 0, so scale is 1 and quantized values are weights + 8
+    block = torch.cat((torch.arange(-8, 8), torch.arange(7, -9, -1))).float()[None]
+    qs = quantize_q4_0(block)[0, 2:].view(torch.uint8)
+    # w[i] in low nibble and w[i + 16] in high nibble
+    assert ((qs & 0x0F) == torch.arange(16)).all()
+    assert ((qs >> 4) == torch.arange(15, -1, -1)).all()
+
+
 def test_quantize_q4_1():
     q_tensor = quantize_q4_1(weight).int()
     # fmt: off
@@ -175,6 +198,230 @@ def test_quantize_q5_1():
     assert (q_tensor == ggml_q_tensor).all()
 
 
+@pytest.mark.parametrize("quantize_fn", [quantize_q8_0, quantize_q4_0, quantize_q4_1, quantize_q5_0, quantize_q5_1])
+@pytest.mark.parametrize("dtype", [torch.half, torch.bfloat16])
+def test_quantize_upcast(quantize_fn, dtype):
+    # low precision weight should be quantized in float32
+    low_precision_weight = weight.to(dtype)
+    assert (quantize_fn(low_precision_weight) == quantize_fn(low_precision_weight.float())).all()
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+@pytest.mark.parametrize("quantize_fn", [quantize_q8_0, quantize_q4_0, quantize_q4_1, quantize_q5_0, quantize_q5_1])
+def test_quantize_cuda(quantize_fn):
+    assert (quantize_fn(weight.cuda()).cpu() == quantize_fn(weight)).all()
+
+
+@pytest.mark.skipif(
+    getattr(_C, "quantize_q4_0", None) is None, reason="chatglm_cpp._C is not built with native quantizers"
+)
+@pytest.mark.parametrize("ggml_type, quantize_fn", [(GGMLType.Q8_0, quantize_q8_0), (GGMLType.Q4_0, quantize_q4_0)])
+def test_quantize_native(monkeypatch, ggml_type, quantize_fn):
+    native_quantize_fn = getattr(_C, f"quantize_{ggml_type.name.lower()}")
+    native_calls = []
+
+    def spy(x):
+        native_calls.append(x.shape)
+        return native_quantize_fn(x)
+
+    monkeypatch.setattr(_C, f"quantize_{ggml_type.name.lower()}", spy)
+
+    tensor = torch.randn(64, 256)
+    native = encode_tensor(tensor, ggml_type, native_quantize=True)
+    assert native_calls == [(64, 256)]
+
+    # same block layout as torch: scales match exactly, while ggml may round a few halfway weights differently
+    ref = quantize_fn(tensor)
+    assert native.dtype == ref.dtype and native.shape == ref.shape
+    assert (native[:, :2] == ref[:, :2]).all()
+    assert (native != ref).float().mean() < 1e-2
+
+
+@pytest.mark.parametrize("ggml_type, quantize_fn", [(GGMLType.Q8_0, quantize_q8_0), (GGMLType.Q4_0, quantize_q4_0)])
+def test_quantize_native_fallback(monkeypatch, ggml_type, quantize_fn):
+    def fail(x):
+        raise AssertionError("native quantizer should not be called")
+
+    # native quantizers are opt-in
+    monkeypatch.setattr("chatglm_cpp.convert._C", SimpleNamespace(quantize_q8_0=fail, quantize_q4_0=fail))
+    assert (encode_tensor(weight, ggml_type) == quantize_fn(weight)).all()
+
+    # an extension built before the native quantizers were added falls back to torch
+    monkeypatch.setattr("chatglm_cpp.convert._C", SimpleNamespace())
+    assert (encode_tensor(weight, ggml_type, native_quantize=True) == quantize_fn(weight)).all()
+
+
+@pytest.mark.parametrize("ggml_type", list(GGMLType))
+def test_dump_tensor_chunked(tmp_path, monkeypatch, ggml_type):
+    tensor = torch.randn(16, 128)
+
+    with open(tmp_path / "whole.bin", "wb") as f:
+        dump_tensors(f, [("weight", tensor, ggml_type, None)])
+
+    # encode & write one row at a time
+    monkeypatch.setattr("chatglm_cpp.convert.DUMP_CHUNK_SIZE", 1)
+    with open(tmp_path / "chunked.bin", "wb") as f:
+        dump_tensors(f, [("weight", tensor, ggml_type, None)])
+
+    # encode rows on a thread pool
+    with open(tmp_path / "parallel.bin", "wb") as f, ThreadPoolExecutor(max_workers=4) as executor:
+        dump_tensors(f, [("weight", tensor, ggml_type, None)], executor=executor)
+
+    assert (tmp_path / "whole.bin").read_bytes() == (tmp_path / "chunked.bin").read_bytes()
+    assert (tmp_path / "whole.bin").read_bytes() == (tmp_path / "parallel.bin").read_bytes()
+
+
+@pytest.mark.parametrize("ggml_type", list(GGMLType))
+def test_dump_tensor_empty(tmp_path, ggml_type):
+    with open(tmp_path / "empty.bin", "wb") as f:
+        tensor_info = dump_tensors(f, [("weight", torch.empty(0, 32), ggml_type, None)])
+
+    # header only: name length, name, ndim, shape & dtype, padded to GGML_MEM_ALIGN
+    assert tensor_info == [("weight", (0, 32), ggml_type)]
+    header = struct.pack("i", 6) + b"weight" + struct.pack("iiii", 2, 0, 32, ggml_type.value)
+    assert (tmp_path / "empty.bin").read_bytes() == header + b"\0" * (-len(header) % 16)
+
+
+def test_dequantize_weight_int4():
+    int4_weight = torch.tensor([[-8, 7, 0, -1], [3, -5, 1, -2]], dtype=torch.int8)
+    # two int4 weights per byte, the former in the high nibble
+    packed_weight = (int4_weight[:, 0::2] << 4) | (int4_weight[:, 1::2] & 0x0F)
+    scale = torch.tensor([0.5, 2.0])
+    assert torch.equal(dequantize_weight(packed_weight, scale, 4), int4_weight * scale[:, None])
+
+
+@pytest.mark.parametrize("quantization_bit", [4, 8])
+def test_dump_tensor_dequantize(tmp_path, monkeypatch, quantization_bit):
+    tensor = torch.randint(-128, 128, (16, 128), dtype=torch.int8)
+    scale = torch.rand(16)
+
+    with open(tmp_path / "dequantized.bin", "wb") as f:
+        ((_, shape, _),) = dump_tensors(
+            f, [("weight", dequantize_weight(tensor, scale, quantization_bit), GGMLType.Q4_0, None)]
+        )
+
+    # de-quantize & encode one row at a time
+    monkeypatch.setattr("chatglm_cpp.convert.DUMP_CHUNK_SIZE", 1)
+    with open(tmp_path / "fused.bin", "wb") as f:
+        ((_, fused_shape, _),) = dump_tensors(
+            f, [("weight", tensor, GGMLType.Q4_0, scale)], quantization_bit=quantization_bit
+        )
+
+    assert shape == fused_shape == (16, 128 * 8 // quantization_bit)
+    assert (tmp_path / "dequantized.bin").read_bytes() == (tmp_path / "fused.bin").read_bytes()
+
+
+def test_dump_state_dict(tmp_path, monkeypatch):
+    state_dict = {
+        "embedding.weight": torch.randn(8, 64),
+        "layernorm.weight": torch.randn(64),
+        "dense.weight": torch.randn(16, 64),
+        "dense.bias": torch.randn(16),
+    }
+
+    with open(tmp_path / "serial.bin", "wb") as f:
+        for name, tensor in state_dict.items():
+            dump_tensors(f, [(name, tensor, GGMLType.Q4_0 if tensor.ndim == 2 else GGMLType.F32, None)])
+
+    # chunks of all tensors flow through one encode & write loop, one row at a time
+    monkeypatch.setattr("chatglm_cpp.convert.DUMP_CHUNK_SIZE", 1)
+    with open(tmp_path / "pipelined.bin", "wb") as f:
+        dump_state_dict(f, list(state_dict.keys()), state_dict, quantization_bit=None, ggml_type=GGMLType.Q4_0)
+
+    assert (tmp_path / "serial.bin").read_bytes() == (tmp_path / "pipelined.bin").read_bytes()
+
+
+def test_load_safetensors_state_dict(tmp_path):
+    assert load_safetensors_state_dict(tmp_path) is None
+
+    state_dict = {"a.weight": torch.randn(4, 8), "a.bias": torch.randn(4), "b.weight": torch.randn(8, 4).half()}
+
+    # single file
+    save_file(state_dict, tmp_path / "model.safetensors")
+    with load_safetensors_state_dict(tmp_path) as lazy_state_dict:
+        assert set(lazy_state_dict) == set(state_dict)
+        assert all(torch.equal(lazy_state_dict[name], tensor) for name, tensor in state_dict.items())
+
+    # sharded files
+    (tmp_path / "model.safetensors").unlink()
+    save_file({"a.weight": state_dict["a.weight"], "a.bias": state_dict["a.bias"]}, tmp_path / "model-1.safetensors")
+    save_file({"b.weight": state_dict["b.weight"]}, tmp_path / "model-2.safetensors")
+    weight_map = {"a.weight": "model-1.safetensors", "a.bias": "model-1.safetensors", "b.weight": "model-2.safetensors"}
+    (tmp_path / "model.safetensors.index.json").write_text(json.dumps({"weight_map": weight_map}))
+    with load_safetensors_state_dict(tmp_path) as lazy_state_dict:
+        assert set(lazy_state_dict) == set(state_dict)
+        assert all(torch.equal(lazy_state_dict[name], tensor) for name, tensor in state_dict.items())
+
+    # checkpoint files are closed on exit
+    with pytest.raises(Exception, match="closed"):
+        lazy_state_dict["a.weight"]
+
+
+def test_convert_lazy_state_dict(tmp_path, monkeypatch):
+    # tiny chatglm2 model: converting from safetensors lazily should match converting the loaded model
+    config = SimpleNamespace(
+        model_type="chatglm",
+        auto_map={"AutoModel": "modeling_chatglm.ChatGLMForConditionalGeneration"},
+        add_bias_linear=False,
+        add_qkv_bias=True,
+        apply_residual_connection_post_layernorm=False,
+        multi_query_attention=True,
+        original_rope=True,
+        post_layer_norm=True,
+        rmsnorm=True,
+        padded_vocab_size=8,
+        hidden_size=32,
+        num_attention_heads=2,
+        kv_channels=16,
+        multi_query_group_num=1,
+        num_layers=1,
+        ffn_hidden_size=32,
+        layernorm_epsilon=1e-5,
+        pre_seq_len=None,
+        seq_length=64,
+        eos_token_id=2,
+        pad_token_id=0,
+    )
+    state_dict = {
+        "transformer.embedding.word_embeddings.weight": torch.randn(8, 32),
+        "transformer.encoder.layers.0.input_layernorm.weight": torch.randn(32),
+        "transformer.encoder.layers.0.self_attention.query_key_value.weight": torch.randn(64, 32),
+        "transformer.encoder.layers.0.self_attention.query_key_value.bias": torch.randn(64),
+        "transformer.encoder.layers.0.self_attention.dense.weight": torch.randn(32, 32),
+        "transformer.encoder.layers.0.post_attention_layernorm.weight": torch.randn(32),
+        "transformer.encoder.layers.0.mlp.dense_h_to_4h.weight": torch.randn(64, 32),
+        "transformer.encoder.layers.0.mlp.dense_4h_to_h.weight": torch.randn(32, 32),
+        "transformer.encoder.final_layernorm.weight": torch.randn(32),
+        "transformer.output_layer.weight": torch.randn(8, 32),
+    }
+    state_dict = {name: tensor.half() for name, tensor in state_dict.items()}
+    tokenizer = SimpleNamespace(
+        tokenizer=SimpleNamespace(special_tokens={}, sp_model=SimpleNamespace(serialized_model_proto=lambda: b"sp"))
+    )
+    model = SimpleNamespace(config=config, transformer=SimpleNamespace(), state_dict=lambda: state_dict)
+    model.eval = lambda: model
+
+    def from_pretrained(*args, **kwargs):
+        assert not (tmp_path / "model.safetensors").exists(), "model should not be loaded for safetensors checkpoint"
+        return model
+
+    monkeypatch.setattr("chatglm_cpp.convert.AutoTokenizer", SimpleNamespace(from_pretrained=lambda *a, **k: tokenizer))
+    monkeypatch.setattr("chatglm_cpp.convert.AutoConfig", SimpleNamespace(from_pretrained=lambda *a, **k: config))
+    monkeypatch.setattr("chatglm_cpp.convert.AutoModel", SimpleNamespace(from_pretrained=from_pretrained))
+
+    # safetensors checkpoint is streamed without loading the model
+    save_file(state_dict, tmp_path / "model.safetensors")
+    with open(tmp_path / "lazy.bin", "wb") as f:
+        convert(f, str(tmp_path))
+
+    # other checkpoints fall back to the state dict of the loaded model
+    (tmp_path / "model.safetensors").unlink()
+    with open(tmp_path / "loaded.bin", "wb") as f:
+        convert(f, str(tmp_path))
+
+    assert (tmp_path / "lazy.bin").read_bytes() == (tmp_path / "loaded.bin").read_bytes()
+
+
 CHATGLM2_MODEL_PATH = Path(
     "~/.cache/huggingface/hub/models--THUDM--chatglm2-6b/snapshots/b1502f4f75c71499a3d566b14463edd62620ce9f"
 ).expanduser()